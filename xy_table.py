@@ -22,14 +22,30 @@
 
 
 import os
+import sys
 import time
+import ctypes
+import select
 import socket
+import logging
 import pyautogui
 import subprocess
+import numpy as np
 from datetime import datetime
 import matplotlib.pyplot as plt
 
 
+## Errors go to error_log.txt.  The logging handler keeps the file open between errors instead
+## of reopening it each time, and it isn't created until the first error is logged.
+logging.basicConfig(handlers=[logging.FileHandler('error_log.txt', delay=True)], level=logging.ERROR,
+                    format='[%(asctime)s]%(message)s', datefmt='%m-%d-%y %I:%M:%S %p')
+
+## Fixed commands, encoded once here instead of every time they are sent to the Lua script
+HOME_BYTES      = b'G90 G0 X0 Y0\n'
+ABSOLUTE_BYTES  = b'G90\n'
+G0_BYTES        = b'G0\n'
+
+
 ## This automates opening Mach 4 and the Lua script for convenience.  Girst it opens the Mach 4 exe with the "mill"
 ## argument, then waits, then opens ZeroBrane which is what Mach 4 uses as a Lua IDE.
 def startup_routine():
@@ -57,170 +73,172 @@ def startup_routine():
         pass
 
 
-## Several hard-coded routines here: home, absolute, pulse x/y, scandxf, viewpath
-def __gcode__(gcode, feedrate, record):
-
-    # Sends the table to (0, 0)
-    if gcode.lower() == 'home':
-        gcode = 'G90 G0 X0 Y0'
-        
-    # Changes the coordinate system from "relative" to "absolute"
-    elif gcode.lower() == 'absolute':
-        gcode = 'G90'
-        
-    # Steps each axis incrementally
-    elif 'pulse x' in gcode.lower():
-        # NOTE: Pulse is dependent on the motor resolution
-        gcode = 'G91 G1 X50 F' + gcode[7:]
-    elif 'pulse y' in gcode.lower():
-        gcode = 'G91 G1 Y50 F' + gcode[7:]
-
-    # Converts .dxf files to GCode .txt files
-    elif 'scandxf' in gcode.lower():
-        try:
-            open(gcode[8:], 'r')
-        except Exception as error:
-            error_log(error)
-            return 'G0'
-
-        # This section creates a .txt with the same name and sends its path to the Lua script
-        txt = '.dxf'
-        txt = gcode[8:].replace(txt, '') + '.txt'
+## Sends the table to (0, 0)
+def home_routine(gcode, feedrate):
+    return HOME_BYTES
+
+
+## Changes the coordinate system from "relative" to "absolute"
+def absolute_routine(gcode, feedrate):
+    return ABSOLUTE_BYTES
+
+
+## Steps each axis incrementally ("pulse x <feedrate>" or "pulse y <feedrate>")
+def pulse_routine(gcode, feedrate):
+    axis = gcode[6:7].upper()
+    if axis not in ('X', 'Y'):
+        return (gcode + '\n').encode()
+
+    # NOTE: Pulse is dependent on the motor resolution
+    return ('G91 G1 ' + axis + '50 F' + gcode[7:] + '\n').encode()
+
+
+## Converts .dxf files to GCode .txt files
+def scandxf_routine(gcode, feedrate):
+    # This section creates a .txt with the same name and sends its path to the Lua script
+    txt = '.dxf'
+    txt = gcode[8:].replace(txt, '') + '.txt'
+    try:
         dxf_to_gcode(gcode[8:], txt, feedrate)
-        gcode = txt
-
-    elif 'viewpath' in gcode.lower():
-        path = gcode[9:]
-        if not '.txt' in path:
-            path = path + '.txt'
-        try:
-            with open(path, 'r') as graph:
-                lines = graph.readlines()
-                x = [float(line.split()[0]) for line in lines]
-                y = [float(line.split()[1]) for line in lines]
-                plt.axis('equal')
-                plt.plot(x, y)
-                plt.show()
-        except Exception as error:
-            error_log(error)
-            return 'G0'
-    return gcode
-
-
-## Clears the DOS terminal (purely visual)
+    except Exception as error:
+        error_log(error)
+        return G0_BYTES
+    return (txt + '\n').encode()
+
+
+## Plots a saved path (.txt from "save") with matplotlib
+def viewpath_routine(gcode, feedrate):
+    path = gcode[9:]
+    if not '.txt' in path:
+        path = path + '.txt'
+    try:
+        x, y = np.loadtxt(path, usecols=(0, 1), unpack=True, ndmin=2)
+        plt.axis('equal')
+        plt.plot(x, y)
+        plt.show()
+    except Exception as error:
+        error_log(error)
+        return G0_BYTES
+    return (gcode + '\n').encode()
+
+
+## Several hard-coded routines here: home, absolute, pulse x/y, scandxf, viewpath.  The routine is
+## looked up by the first word of the command, so the command is only lowercased once.  Returns
+## the line to send to the Lua script as bytes.
+def __gcode__(gcode, feedrate, record_lines):
+    routine = ROUTINES.get(gcode.lower().partition(' ')[0])
+    if routine is None:
+        return (gcode + '\n').encode()
+    return routine(gcode, feedrate)
+
+
+ROUTINES = {
+    'home':     home_routine,
+    'absolute': absolute_routine,
+    'pulse':    pulse_routine,
+    'scandxf':  scandxf_routine,
+    'viewpath': viewpath_routine,
+}
+
+
+## Clears the DOS terminal (purely visual).  An ANSI escape code is written instead of running "cls"
+## because this is called every loop, and "cls" starts a new cmd.exe process each time.
 def clear():
-    os.system('cls')
+    sys.stdout.write('\x1b[2J\x1b[H')
+    sys.stdout.flush()
+
+
+## The Windows console only understands ANSI escape codes once virtual terminal processing is turned on
+def enable_vt_mode():
+    if os.name == 'nt':
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11)                     # STD_OUTPUT_HANDLE
+        mode = ctypes.c_ulong()
+        kernel32.GetConsoleMode(handle, ctypes.byref(mode))
+        kernel32.SetConsoleMode(handle, mode.value | 0x0004)    # ENABLE_VIRTUAL_TERMINAL_PROCESSING
 
 
 ## This function converts .dxf files to GCode .txt files by looking for "AcDbLine"
 ## objects in the .dxf fle and converting them to equivalent GCode commands
 def dxf_to_gcode(openfilepath, savefile, feedrate):
     # Based on code from: https://sites.google.com/site/richardcncprojects/
-    qty         = 1000	        # Quantity of memory to be used
     r           = 2 	        # Round off to decimal places
-    text 	    = ''
-    error	    = ''
-    linecount	= 1
-    count       = 0
-    feedflag    = 0
-    xmax        = 0
-    xmin        = 0
-    ymax        = 0
-    ymin        = 0
-    xstart      = [0 for i in range(qty)]
-    ystart      = [0 for i in range(qty)]
-    xend        = [0 for i in range(qty)]
-    yend        = [0 for i in range(qty)]
-    file = open(openfilepath, 'r')
-
-    # DXF read loop
-    while True:
-        text = file.readline()
-        text = text.strip()
-        print(text)
-
-        if text == 'EOF':
-            break
-        
-        if text.lower() == 'acdbline':
-            while True:
-                text = file.readline()
-                text = text.strip()
-                
-                if text == '10':
-                    text = file.readline() # X start position
-                    text = text.strip()
-                    xstart[linecount] = float(text)
-                    text = 'nothing'
-                
-                if text == '20':
-                    text = file.readline() # Y start position
-                    text = text.strip()
-                    ystart[linecount] = float(text)
-                    text = 'nothing'
-                
-                if text == '11':
-                    text = file.readline() # X end position
-                    text = text.strip()
-                    xend[linecount] = float(text)
-                    text = 'nothing'
-                
-                if text == '21':
-                    text = file.readline() # Y end position
-                    text = text.strip()
-                    yend[linecount] = float(text)
-                    text = 'nothing'
-                
-                if text == '0': # End of data
-                    if ystart[linecount] > ymax: ymax = ystart[linecount]
-                    if ystart[linecount] < ymin: ymin = ystart[linecount]
-                    if yend[linecount] > ymax: ymax = yend[linecount]
-                    if yend[linecount] < ymin: ymin = yend[linecount]
-                    if xstart[linecount] > xmax: xmax = xstart[linecount]
-                    if xstart[linecount] < xmin: xmin = xstart[linecount]
-                    if xend[linecount] > xmax: xmax = xend[linecount]
-                    if xend[linecount] < xmin: xmin = xend[linecount]
-                    linecount = linecount + 1
-                    break
-                            
-            if linecount >= qty:
-                error = error + 'Error: ran out of dimentioned line arrey. Increase qty value.\n'
-                text = 'EOF'
-                break
-
-    file.close	
-            
-    # GCode generator
-    gcode = 'G90 G17 G21\n'
-
-    for i in range(1, linecount):
-        if xstart[i] != xend[i - 1] or ystart[i] != yend[i - 1]:
-            gcode = gcode + 'G1 X' + str(round(xstart[i], r)) + ' Y' + str(round(ystart[i], r)) + '\n'
-            feedflag = 0
-            
-        gcode = gcode + 'G1 X' + str(round(xend[i], r)) + ' Y' + str(round(yend[i], r))
-        
-        if feedflag == 0:
-            gcode = gcode + ' F' + feedrate
-            feedflag = 1
-        
-        gcode = gcode + '\n'
-            
-    if error != '':
-        print(error)
+
+    xstart, ystart, xend, yend = parse_dxf(openfilepath)
+    xmin, xmax, ymin, ymax = bounding_box(xstart, ystart, xend, yend)
+
+    # GCode generator: a move to the start point is only needed where a line doesn't begin
+    # where the previous one ended (the table starts at the origin)
+    rapid = (xstart != np.append(0, xend[:-1])) | (ystart != np.append(0, yend[:-1]))
+
+    # The feedrate is set on the first move and again after every move to a new start point
+    feed = rapid.copy()
+    feed[:1] = True
+
+    # Every row uses the same template, built once ('G1 X%.2f Y%.2f' for r = 2), so the rounding is done by the format
+    move = 'G1 X%.{0}f Y%.{0}f'.format(r)
+    rows = ['G90 G17 G21']
+    for xs, ys, xe, ye, jump, setfeed in zip(xstart.tolist(), ystart.tolist(), xend.tolist(), yend.tolist(),
+                                             rapid.tolist(), feed.tolist()):
+        if jump:
+            rows.append(move % (xs, ys))
+        if setfeed:
+            rows.append(move % (xe, ye) + ' F' + feedrate)
+        else:
+            rows.append(move % (xe, ye))
+    gcode = '\n'.join(rows) + '\n'
 
     # Save to .txt
-    file = open(savefile, 'w')
-    file.write(gcode)
-    file.close()
+    with open(savefile, 'w') as file:
+        file.write(gcode)
+
+
+## Reads the start and end points of every "AcDbLine" object in a .dxf file into four float
+## arrays: (xstart, ystart, xend, yend).  This is the whole parse, so a faster reader can be
+## swapped in here without touching the GCode generator.
+def parse_dxf(openfilepath):
+    # DXF read: the file is pairs of lines (group code, then value), so it is read in one go.  Only the
+    # short group codes go into a NumPy array; the values stay in a list, since a fixed-width array
+    # would size every value to the longest line in the file.
+    with open(openfilepath, 'r') as file:
+        lines = file.read().splitlines()
+    values = lines[1::2]
+    codes = np.array([code.strip() for code in lines[0:len(values) * 2:2]], dtype=str)
+
+    # A pair belongs to a line if an "AcDbLine" marker came after the last "0" (start of object) code.
+    # Only subclass markers (group code 100) can hold "AcDbLine", so only those values are checked.
+    index = np.arange(codes.size)
+    subclass = np.flatnonzero(codes == '100')
+    isline = np.zeros(codes.size, dtype=bool)
+    isline[subclass] = [values[i].strip().lower() == 'acdbline' for i in subclass]
+    marker = np.maximum.accumulate(np.where(isline, index, -1))
+    start = np.maximum.accumulate(np.where(codes == '0', index, -1))
+    inline = marker > start
+
+    # Picks out the values of one group code from the line objects
+    def points(code):
+        return np.array([float(values[i]) for i in np.flatnonzero(inline & (codes == code))], dtype=np.float64)
+
+    xstart = points('10')       # X start positions
+    ystart = points('20')       # Y start positions
+    xend = points('11')         # X end positions
+    yend = points('21')         # Y end positions
+    return xstart, ystart, xend, yend
+
+
+## Finds the extents of the lines from the .dxf file.  The table starts at the origin, so (0, 0)
+## is always included, which also keeps this safe for a file with no lines in it.
+def bounding_box(xstart, ystart, xend, yend):
+    xmin = min(xstart.min(initial=0), xend.min(initial=0))
+    xmax = max(xstart.max(initial=0), xend.max(initial=0))
+    ymin = min(ystart.min(initial=0), yend.min(initial=0))
+    ymax = max(ystart.max(initial=0), yend.max(initial=0))
+    return xmin, xmax, ymin, ymax
 
 
 ## Logs errors in error_log.txt so the user knows what went wrong
 def error_log(err):
-    error = datetime.now().strftime('[%m-%d-%y %I:%M:%S %p]') + str(err) + '\n'
-    error_history = open('error_log.txt', 'a')
-    error_history.write(error)
-    error_history.close()
+    logging.error(err)
 
 
 
@@ -228,14 +246,16 @@ def error_log(err):
 
 ### MAIN BODY & I/O LOOP OF PROGRAM FOLLOWS ###
 
+enable_vt_mode()
 clear()
 
 if __name__ == '__main__':
     HOST        = '127.0.0.1'
     PORT        = 2504
+    interactive = True          # Spins on the socket during a move, using a full CPU core (set False on a shared CPU)
     feedrate    = '600'
     repeat      = 0
-    record      = ''
+    record_lines = []
     check       = ''
     readout     = [0, 0, 0]
 
@@ -251,21 +271,23 @@ if __name__ == '__main__':
 
         print('Waiting for connection from Lua script...')
         conn, addr = s.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # Sends short GCode commands right away
 
         with conn:
             while True:
-                pos = conn.recv(1024).decode()
-                pos = pos.split(',')
+                # The position fields stay as bytes; only X, Y and Z are decoded, for display and the record
+                pos = conn.recv(1024).split(b',')
+                xyz = [field.decode() for field in pos[:3]]
 
                 # Latency = current time - time sent from Lua script
-                latency = 'Latency: ' + str(abs(time.time() * 1000 - float(pos[3][:13])))[:5]
+                latency = f'Latency: {abs(time.time_ns() // 1000000 - int(pos[3][:13])):5d}'
 
                 # Rrcords the coordinates and POSIX timestamp together
-                record = record + '{} {} {} '.format(*pos) + str(datetime.timestamp(datetime.now())) + '\n'
+                record_lines.append('{} {} {} '.format(*xyz) + str(datetime.timestamp(datetime.now())))
 
                 # Assigns each motor axis/latency to its respective label
                 clear()
-                readout = [str('{:<8}'.format(pos[i]))[:6] for i in range(3)]
+                readout = [f'{xyz[i]:<6.6}' for i in range(3)]
                 print('X: {} | Y: {} | Z: {}        {} ms'.format(*readout, latency))
 
                 gcode = input('>>')
@@ -284,12 +306,12 @@ if __name__ == '__main__':
                     if not '.txt' in gcode:
                         gcode = gcode + '.txt'
                     file = open(gcode, 'w') 
-                    file.write(record) 
+                    file.write('\n'.join(record_lines) + '\n')
                     file.close()
                     
-                # Clears the coordinate and time history stored in "record"
+                # Clears the coordinate and time history stored in "record_lines"
                 elif gcode == 'clear':
-                    record = ''
+                    record_lines.clear()
 
                 # Defines feedrate for .dxf scanning
                 elif 'feedrate' in gcode.lower():
@@ -297,26 +319,36 @@ if __name__ == '__main__':
 
                 # Sends whichever GCode/commands have been inputted
                 try:
-                    conn.send(bytes(__gcode__(gcode, feedrate, record) + '\n', 'utf8'))
+                    conn.send(__gcode__(gcode, feedrate, record_lines))
                 except Exception as error:
                     error_log(error)
 
                 clear()
 
                 # Lua appeds an extra space (" ") to indicate when the motors have stopped
-                while not ' ' in pos:
-                    pos = conn.recv(1024).decode()
+                first = True
+                while not b' ' in pos:
+                    # In interactive mode the rest of the move spins on a zero-timeout select() instead of sleeping in
+                    # recv(), so the thread is already running when an update arrives rather than waiting to be woken.
+                    # The first read of each move still blocks so the CPU isn't kept busy while the motors start.
+                    if interactive and not first:
+                        while not select.select([conn], [], [], 0)[0]:
+                            pass
+                    first = False
+                    pos = conn.recv(1024)
+                    parts = pos.split(b',')
+                    xyz = [field.decode() for field in parts[:3]]
 
                     # If the time has updated since the last check, add the coordinates to the record
                     if check != str(datetime.timestamp(datetime.now())) and check != '':
-                        record = record + '{} {} {} '.format(*pos.split(',')) + check + '\n'
+                        record_lines.append('{} {} {} '.format(*xyz) + check)
 
                     check = str(datetime.timestamp(datetime.now())) # Updates time check
-                    latency = 'Latency: ' + str(abs(time.time() * 1000 - float(pos.split(',')[3][:13])))[:5]
+                    latency = f'Latency: {abs(time.time_ns() // 1000000 - int(parts[3][:13])):5d}'
 
                     ## Performs a similar operation as the main print, but "pos" needs to stay intact for the main loop
-                    ## so this loop modifies the string rather than modifying "pos."
-                    readout = [str('{:<8}'.format(pos.split(',')[i])[:6]) for i in range(3)]
+                    ## so this loop works from "parts" and "xyz" (split once per update) rather than modifying "pos."
+                    readout = [f'{xyz[i]:<6.6}' for i in range(3)]
                     print('X: {} | Y: {} | Z: {}        {} ms'.format(*readout, latency), end='\r')
 
                     ## This section uses "end='\r'" instead of "clear()" because the former is quicker in this case